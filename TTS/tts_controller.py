@@ -1,12 +1,149 @@
 import argparse
-import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as ET  # libxml2-backed parser, faster on large question banks
+    _USING_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _USING_LXML = False
 from chatterbox.tts import ChatterboxTTS
+import torch
 import torchaudio
 import os
+import sys
+import json
+import hashlib
+import shutil
+import threading
 import traceback  # For full error traces
 import logging  # For file and console logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from functools import lru_cache
 
-def generate_tts(xml_path, output_dir, voice=None, voices_dir='voices', logger=None):
+@lru_cache(maxsize=2)
+def _get_model(device):
+    # Loaded once per device and reused by every generate_tts call (matters in --server mode)
+    model = ChatterboxTTS.from_pretrained(device=device)
+    _autocast_t3(model, device)
+    return model
+
+def _autocast_t3(model, device):
+    # Run the T3 token decoder in bf16 (fp16 on cards without bf16 support) on GPU. S3Gen/HiFT stays
+    # in fp32: its vocoder feeds torch.stft, which has no bf16 kernel and is not cast back by autocast.
+    # CPU stays in fp32
+    if not device.startswith("cuda"):
+        return
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    t3_inference = model.t3.inference
+    def inference(*args, **kwargs):
+        with torch.autocast(device_type="cuda", dtype=dtype):
+            return t3_inference(*args, **kwargs)
+    model.t3.inference = inference
+
+_compiled_models = set()  # Models that already went through _compile_model (compiled or fell back to eager)
+
+def _compile_model(model):
+    # JIT-compile the hot submodules: the T3 Llama backbone (run once per decoded token)
+    # and the S3Gen flow-matching estimator (run once per ODE step).
+    # Must be called with model.conds set, since the warm-up generates with the current voice
+    logger = logging.getLogger(__name__)
+    compiled = []  # Modules whose forward has been replaced so far, restored on failure
+    # Everything up to and including the warm-up is covered, so any compile error (missing submodule,
+    # unsupported backend, failure on first call) falls back to eager mode instead of failing the run
+    try:
+        logger.info("Compiling TTS model (warm-up)...")
+        backbone = model.t3.tfmr
+        estimator = model.s3gen.flow.decoder.estimator
+        backbone.forward = torch.compile(backbone.forward, dynamic=True, fullgraph=False)
+        compiled.append(backbone)
+        estimator.forward = torch.compile(estimator.forward, fullgraph=False)
+        compiled.append(estimator)
+        # Warm up so compilation isn't paid by the first question
+        model.generate("Hello.")
+        logger.info("TTS model compiled.")
+    except Exception as e:
+        logger.warning(f"torch.compile failed, falling back to eager mode: {e}")
+        for module in compiled:
+            module.__dict__.pop('forward', None)  # Drop the compiled instance attribute, restoring the class method
+    _compiled_models.add(model)  # Settled on compiled or eager; don't try again for this model
+
+def _voice_stamp(voice_path):
+    # Modification time and size of a voice sample, so a re-recorded file is never mistaken for the old one
+    stat = os.stat(voice_path)
+    return stat.st_mtime_ns, stat.st_size
+
+@lru_cache(maxsize=16)
+def _get_conditionals(model, voice_path, voice_stamp):
+    # Encode each voice sample only once; generate() would otherwise redo this for every question.
+    # voice_stamp is part of the cache key so a long-running --server picks up replaced voice files
+    model.prepare_conditionals(voice_path)
+    return model.conds
+
+def _utterance_key(text, voice_path, voice_stamp):
+    # Content hash identifying one spoken text in one voice; the voice stamp makes a re-recorded sample invalidate old audio
+    mtime_ns, size = voice_stamp
+    return hashlib.sha1(f"{text}|{voice_path}|{mtime_ns}|{size}".encode('utf-8')).hexdigest()
+
+class _Manifest:
+    # Sidecar manifest.json in the output directory mapping each WAV file name to the utterance key
+    # it was generated from, so unchanged questions can be skipped on the next run
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, "manifest.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}  # Missing or unreadable manifest: regenerate everything
+
+    def is_current(self, output_path, key):
+        return self.entries.get(os.path.basename(output_path)) == key and os.path.exists(output_path)
+
+    def invalidate(self, output_path):
+        # Called before a WAV is (over)written, so a save killed halfway (e.g. by the game cancelling the
+        # process) can never leave a truncated file behind with a matching key
+        with self._lock:
+            if self.entries.pop(os.path.basename(output_path), None) is not None:
+                self._write()
+
+    def update(self, output_path, key):
+        # Called from the I/O pool after each successful save
+        with self._lock:
+            self.entries[os.path.basename(output_path)] = key
+            self._write()
+
+    def _write(self):
+        # Caller holds the lock; write to a temp file first so a crash never leaves a torn manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+def _save_wav(output_path, wav, sample_rate, idx, logger, manifest, key):
+    manifest.invalidate(output_path)
+    torchaudio.save(output_path, wav, sample_rate)
+    manifest.update(output_path, key)
+    logger.info(f"Generated audio for question {idx}: {output_path}")
+
+def _check_saves(save_futures):
+    # Re-raise the first failed save right away and drop finished ones, so a broken disk stops the run early
+    pending = []
+    for future in save_futures:
+        if future.done():
+            future.result()
+        else:
+            pending.append(future)
+    return pending
+
+def _log_finished(logger, skipped_missing_voice):
+    # Only report success when every question with TTS text has audio (generated, copied or up to date)
+    if skipped_missing_voice:
+        logger.warning(f"TTS generation finished, but {skipped_missing_voice} question(s) have no audio because their voice sample is missing.")
+    else:
+        logger.info("TTS generation completed successfully!")
+
+def generate_tts(xml_path, output_dir, voice=None, voices_dir='voices', logger=None, device="cpu", compile_model=False):
     try:
         logger.info("Starting TTS generation...")  # Debug: Entry point
         
@@ -14,80 +151,180 @@ def generate_tts(xml_path, output_dir, voice=None, voices_dir='voices', logger=N
         os.makedirs(output_dir, exist_ok=True)
         logger.info(f"Output directory: {output_dir}")
         
-        # Parse XML
+        # Stream-parse the XML, keeping only what TTS needs per question and freeing each element,
+        # grouped by lecturer in the same pass (each question keeps its global index for file naming)
         logger.info("Parsing XML...")
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-        logger.info(f"Found {len(list(root.findall('Question')))} questions in XML.")
-        
-        # Load TTS model (use CPU if no GPU)
-        logger.info("Loading ChatterboxTTS model...")
-        model = ChatterboxTTS.from_pretrained(device="cpu")  # Switch to "cuda" if GPU available
-        logger.info("Model loaded successfully.")
-        
         use_single = bool(voice)
+        questions_by_lecturer = defaultdict(list)
+        question_count = 0
+        # questions.xml is LLM-generated: never let lxml resolve entities or fetch anything from the network
+        parse_options = {'resolve_entities': False, 'no_network': True} if _USING_LXML else {}
+        for _, elem in ET.iterparse(xml_path, events=('end',), **parse_options):
+            if elem.tag != 'Question':
+                continue
+            idx = question_count
+            question_count += 1
+            tts_text = elem.findtext('TTSFriendlyText', default="").strip()
+            if use_single:
+                lecturer_id = None  # Single voice mode, no lecturer iteration
+            else:
+                # Defaulting to "berninger" if LecturerID is missing or empty
+                lecturer_id = elem.findtext('LecturerID', default="").strip()
+                if not lecturer_id:
+                    logger.warning(f"Missing or empty LecturerID for question {idx}; defaulting to 'berninger'.")
+                    lecturer_id = "berninger"
+            questions_by_lecturer[lecturer_id].append((idx, tts_text))
+            elem.clear()
+            if _USING_LXML:
+                # lxml keeps cleared elements attached to the root; detach the already processed siblings too
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        logger.info(f"Found {question_count} questions in XML.")
+        
         if not use_single:
-            # Get unique lecturer IDs from XML, defaulting to "berninger" if missing
-            lecturer_ids = set()
-            for question in root.findall('Question'):
-                lecturer_elem = question.find('LecturerID')
-                if lecturer_elem is not None and lecturer_elem.text:
-                    lecturer_ids.add(lecturer_elem.text)
-                else:
-                    logger.warning(f"Missing or empty LecturerID for a question; defaulting to 'berninger'.")
-                    lecturer_ids.add("berninger")
             default_voice = os.path.join(voices_dir, "berninger.wav")
-            logger.info(f"Unique Lecturer IDs (after defaults): {lecturer_ids}")
+            logger.info(f"Unique Lecturer IDs (after defaults): {set(questions_by_lecturer)}")
         else:
-            lecturer_ids = [None]  # Single voice mode, no lecturer iteration
             logger.info("Using single voice mode.")
         
-        # Process questions for each lecturer sequentially
-        for lecturer_id in lecturer_ids:
-            logger.info(f"Processing audio for lecturer: {lecturer_id if lecturer_id else 'single voice'}")
+        # Work out which questions still need audio before touching the model, so an up-to-date run stays cheap
+        manifest = _Manifest(output_dir)
+        generated = {}  # Utterance key -> (first output path, its save future), so repeated texts are copied instead of regenerated
+        lecturer_jobs = []  # (lecturer_id, voice_path, voice_stamp, needs_model, [(idx, tts_text, output_path, key)])
+        up_to_date_count = 0
+        skipped_missing_voice = 0  # Questions left without audio because no voice sample exists for them
+        for lecturer_id, lecturer_questions in questions_by_lecturer.items():
             voice_path = voice if use_single else os.path.join(voices_dir, f"{lecturer_id}.wav")
             if not use_single and not os.path.exists(voice_path):
                 logger.warning(f"Voice sample not found for {lecturer_id} at {voice_path}. Using default.")
                 voice_path = default_voice
             
             if not os.path.exists(voice_path):
-                logger.warning(f"Voice sample not found at {voice_path}. Skipping.")
+                logger.warning(f"Voice sample not found at {voice_path}. Skipping {len(lecturer_questions)} question(s).")
+                skipped_missing_voice += len(lecturer_questions)
                 continue
             
-            logger.info(f"Using voice file: {voice_path}")
+            voice_stamp = _voice_stamp(voice_path)
+            pending = []
+            lecturer_up_to_date = 0
+            for idx, tts_text in lecturer_questions:
+                if not tts_text:
+                    logger.warning(f"No TTS text for question {idx}, skipping.")
+                    continue
+                key = _utterance_key(tts_text, voice_path, voice_stamp)
+                output_path = os.path.join(output_dir, f"question_{idx}.wav")
+                if manifest.is_current(output_path, key):
+                    logger.info(f"Audio for question {idx} is up to date, skipping: {output_path}")
+                    generated.setdefault(key, (output_path, None))
+                    lecturer_up_to_date += 1
+                    continue
+                pending.append((idx, tts_text, output_path, key))
+            up_to_date_count += lecturer_up_to_date
+            if not pending:
+                if lecturer_up_to_date:
+                    logger.info(f"All audio for lecturer {lecturer_id if lecturer_id else 'single voice'} is up to date.")
+                continue
+            # Pending questions that repeat an up-to-date file are only copied and need no model
+            needs_model = any(key not in generated for _, _, _, key in pending)
+            lecturer_jobs.append((lecturer_id, voice_path, voice_stamp, needs_model, pending))
+        
+        if not lecturer_jobs:
+            # A missing voice sample is reported by _log_finished; never call that case "up to date"
+            if not skipped_missing_voice:
+                if up_to_date_count:
+                    logger.info("All question audio is up to date; nothing to generate.")
+                else:
+                    logger.warning("Nothing to generate: no question has TTS text.")
+            _log_finished(logger, skipped_missing_voice)
+            return
+        
+        if any(needs_model for _, _, _, needs_model, _ in lecturer_jobs):
+            # Load TTS model (cached after the first call; pass device="cuda" if a GPU is available)
+            logger.info(f"Loading ChatterboxTTS model on {device}...")
+            model = _get_model(device)
+            logger.info("Model loaded successfully.")
+        
+        # Process questions for each lecturer sequentially; WAV files are saved on a small I/O pool
+        save_futures = []
+        with ThreadPoolExecutor(max_workers=2) as io_pool:
+            for lecturer_id, voice_path, voice_stamp, needs_model, pending in lecturer_jobs:
+                logger.info(f"Processing audio for lecturer: {lecturer_id if lecturer_id else 'single voice'}")
+                if needs_model:
+                    logger.info(f"Using voice file: {voice_path}")
+                    model.conds = _get_conditionals(model, voice_path, voice_stamp)
+                    if compile_model and model not in _compiled_models:
+                        _compile_model(model)  # Warms up with the conditionals just set
             
-            # Process questions for this lecturer
-            for idx, question in enumerate(root.findall('Question')):
-                lecturer_elem = question.find('LecturerID')
-                question_lecturer = lecturer_elem.text if lecturer_elem is not None else "berninger" if not use_single else None
-                if not use_single and question_lecturer != lecturer_id:
-                    continue  # Skip questions not matching the current lecturer
-                tts_text_elem = question.find('TTSFriendlyText')
-                tts_text = tts_text_elem.text if tts_text_elem is not None else None
-                if tts_text:
+                # Process questions for this lecturer
+                for idx, tts_text, output_path, key in pending:
+                    if key in generated:
+                        first_path, first_future = generated[key]
+                        if first_future is not None:
+                            first_future.result()  # Wait until the original file is on disk
+                        manifest.invalidate(output_path)
+                        shutil.copyfile(first_path, output_path)
+                        manifest.update(output_path, key)
+                        logger.info(f"Reused audio for question {idx} from {first_path}: identical text with this voice.")
+                        continue
                     logger.info(f"Generating audio for question {idx}: '{tts_text[:50]}...'")  # Truncate for log readability
 
                     # Generate audio with cloned voice
-                    wav = model.generate(tts_text, audio_prompt_path=voice_path)
-                    output_path = os.path.join(output_dir, f"question_{idx}.wav")
-                    torchaudio.save(output_path, wav, model.sr)
-                    logger.info(f"Generated audio for question {idx}: {output_path}")
-                else:
-                    logger.warning(f"No TTS text for question {idx}, skipping.")
+                    wav = model.generate(tts_text)  # Uses the cached voice conditionals set above
+                    # Encode and write in the background while the next question is generated
+                    save_futures = _check_saves(save_futures)
+                    future = io_pool.submit(_save_wav, output_path, wav, model.sr, idx, logger, manifest, key)
+                    save_futures.append(future)
+                    generated[key] = (output_path, future)
         
-        logger.info("TTS generation completed successfully!")
+        for future in save_futures:
+            future.result()  # Surface any save error
+        
+        _log_finished(logger, skipped_missing_voice)
         
     except Exception as e:
         logger.exception(f"Error during TTS generation: {e}")  # Logs full traceback
         raise  # Re-raise to ensure process exits with error code
 
+def serve(voices_dir, logger, device="cpu", compile_model=False):
+    # Read one JSON job per line from stdin, e.g. {"xml": "...", "output": "...", "voice": "..."},
+    # and answer each with a JSON status line on stdout. The model stays loaded between jobs.
+    # stdout is reserved for these status lines: anything chatterbox/perth print while loading or
+    # generating is redirected to stderr so a client never reads non-JSON output
+    status_out = sys.stdout
+    logger.info("TTS server mode: waiting for jobs on stdin...")
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            xml_path, output_dir = job['xml'], job['output']
+        except (ValueError, KeyError, TypeError) as e:
+            logger.exception(f"Invalid TTS job {line[:100]!r}: {e}")
+            status = {"status": "error", "error": f"invalid job: {e}"}
+        else:
+            try:
+                with redirect_stdout(sys.stderr):
+                    generate_tts(xml_path, output_dir, job.get('voice'), job.get('voices_dir', voices_dir), logger, job.get('device', device), compile_model)
+                status = {"status": "ok", "output": output_dir}
+            except Exception as e:
+                logger.error(f"TTS job failed: {e}")  # Traceback already logged by generate_tts
+                status = {"status": "error", "error": str(e)}
+        print(json.dumps(status), file=status_out, flush=True)
+    logger.info("TTS server mode: stdin closed, shutting down.")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--xml', required=True, help="Path to questions.xml")
-    parser.add_argument('--output', required=True, help="Output directory for WAV files")
+    parser.add_argument('--xml', required=False, help="Path to questions.xml")
+    parser.add_argument('--output', required=False, help="Output directory for WAV files")
     parser.add_argument('--voice', required=False, help="Path to single voice sample WAV")
     parser.add_argument('--voices_dir', required=False, default='voices', help="Directory for lecturer voice samples")
+    parser.add_argument('--device', required=False, default='cpu', help="Torch device for the TTS model (cpu or cuda)")
+    parser.add_argument('--compile', action='store_true', help="JIT-compile the model with torch.compile (slow first run, faster generation)")
+    parser.add_argument('--server', action='store_true', help="Keep the model loaded and read JSON jobs ({xml, output, voice}) from stdin")
     args = parser.parse_args()
+    if not args.server and (not args.xml or not args.output):
+        parser.error("--xml and --output are required unless --server is given")
     
     # Set up logging to AppData folder (console + file)
     log_dir = os.path.join(os.environ['APPDATA'], "DHBW-Game", "logs")
@@ -106,6 +343,9 @@ if __name__ == "__main__":
     logger.info(f"TTS Controller started. Log file: {log_path}")
     
     try:
-        generate_tts(args.xml, args.output, args.voice, args.voices_dir, logger)
+        if args.server:
+            serve(args.voices_dir, logger, args.device, args.compile)
+        else:
+            generate_tts(args.xml, args.output, args.voice, args.voices_dir, logger, args.device, args.compile)
     except Exception as e:
         logger.exception(f"Fatal error: {e}")
\ No newline at end of file